@@ -0,0 +1,62 @@
+#!/usr/bin/env python2
+# Encoding: utf-8
+
+# Compare the poll latency of the controller's register backends on a running switch
+# Usage: ./benchmark-backends.py -n 100 > path/to/benchmark.txt
+# Each poll does what one iteration of controller.py does: read the RTT registers and
+# table occupancies, then reset the RTT registers. Don't run it next to a live controller.
+# Output columns:
+# backend, # polls, mean (ms), median (ms), 99th percentile (ms), max (ms)
+
+from __future__ import print_function
+import time, argparse
+from controller import BACKENDS, DEFAULT_THRIFT_PORT, percentile, read_rtt_registers, reset_rtt_registers
+
+def time_polls(backend, num_polls, packed):
+    durations = []
+    for _ in range(num_polls):
+        start = time.time()
+        read_rtt_registers(backend, packed)
+        backend.register_read('table_occupancies')
+        reset_rtt_registers(backend, packed)
+        durations.append((time.time() - start) * 1000)
+    durations.sort()
+    return durations
+
+def main(args):
+    for backend_name in args.backends:
+        backend = BACKENDS[backend_name](args.thrift_port)
+        time_polls(backend, args.warmup, args.packed) # Let connections and caches settle
+        durations = time_polls(backend, args.num_polls, args.packed)
+        backend.close()
+        print("%s,%d,%.3f,%.3f,%.3f,%.3f" % (
+            backend_name,
+            len(durations),
+            sum(durations) / len(durations),
+            percentile(durations, 0.5),
+            percentile(durations, 0.99),
+            durations[-1]
+        ))
+
+def premain():
+    parser = argparse.ArgumentParser(description='Poll latency benchmark for RTT-P4 controller backends')
+    parser.add_argument('-n', '--num', dest='num_polls', type=int,
+        help='Number of timed polls per backend (default 100)',
+        action="store", required=False, default=100)
+    parser.add_argument('-w', '--warmup', dest='warmup', type=int,
+        help='Number of untimed polls per backend before timing (default 5)',
+        action="store", required=False, default=5)
+    parser.add_argument('-b', '--backends', dest='backends', nargs='+', choices=sorted(BACKENDS.keys()),
+        help='Backends to compare (default all)',
+        action="store", required=False, default=sorted(BACKENDS.keys()))
+    parser.add_argument('--packed', dest='packed',
+        help='Read packed RTT records (program.p4 compiled with PACKED_RTTS_FLAG)',
+        action="store_true", required=False)
+    parser.add_argument('--thrift-port', dest='thrift_port', type=int,
+        help='Thrift server port of the switch (default 9090)',
+        action="store", required=False, default=DEFAULT_THRIFT_PORT)
+    args = parser.parse_args()
+    main(args)
+
+if __name__ == '__main__':
+    premain()
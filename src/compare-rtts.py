@@ -1,11 +1,29 @@
 # Read two CSVs of RTTs, actual and observed, and evaluate the latter
 # Usage: python3 compare-rtts.py path/to/actual.csv path/to/observed.csv 0.1
 # Note: Replace 0.1 with the replay speed. Assume 1 if omitted.
+# For a switch wrapping timestamps (program.p4 with WRAP_TIMESTAMPS_FLAG), add 32, the timestamp bits:
+# python3 compare-rtts.py path/to/actual.csv path/to/observed.csv 0.1 32
+# Actual RTTs are then compared modulo 2^32 microseconds, as the switch measures them.
+# The observed RTTs may also be the binary file written by controller.py -o (see observed_rtts.py).
 # Assumption: observed RTTs (calculated by the P4 switch) are integers
 # Generates a "*.marked.csv" file, which adds a column at the end for RTT error.
 # Prints results. "Bogus" refers to spurious observed RTTs. "MSE" is mean sq. error
 
-import sys, csv, numpy
+import sys, csv, numpy, socket, struct
+from observed_rtts import is_observed_rtts_file, load_observed_rtts
+
+# Flows are keyed by (sip, dip, spt, dpt, seq, ack) with IPs as integers
+KEY_COLUMNS = ['src_ip', 'dst_ip', 'src_port', 'dst_port', 'seq', 'ack']
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def row_to_key(row):
+    return (ip_to_int(row[2]), ip_to_int(row[3])) + tuple(int(field) for field in row[4:8])
+
+def key_to_string(key):
+    return ",".join([socket.inet_ntoa(struct.pack('!I', key[0])), socket.inet_ntoa(struct.pack('!I', key[1]))] +
+        [str(field) for field in key[2:]])
 
 actual_filename = sys.argv[1]
 observed_filename = sys.argv[2]
@@ -14,22 +32,37 @@ replay_speed = 1
 if len(sys.argv) > 3:
     replay_speed = float(sys.argv[3])
 
-# Read observed CSV
+timestamp_modulus = None
+if len(sys.argv) > 4:
+    timestamp_modulus = 2 ** int(sys.argv[4])
+
+# Read observed RTTs
 observed_rtts = dict()
 num_observed_rtts = 0
-with open(observed_filename) as observed_file:
-    csv_reader = csv.reader(observed_file, delimiter=',')
-    for row in csv_reader:
-        if row[-1] == "0" or row[-2] == "0":
-            continue
-        key = ",".join(row[2:8])
-        rtt = int(row[0])
-        register_index_of_rtt = int(row[1])
+if is_observed_rtts_file(observed_filename):
+    observed = load_observed_rtts(observed_filename)
+    observed = observed[(observed['seq'] != 0) & (observed['ack'] != 0)]
+    keys = zip(*[observed[column].tolist() for column in KEY_COLUMNS])
+    for key, rtt, register_index_of_rtt in zip(keys, observed['rtt'].tolist(), observed['register_index'].tolist()):
         if key in observed_rtts:
             observed_rtts[key].append((rtt, register_index_of_rtt))
         else:
             observed_rtts[key] = [(rtt, register_index_of_rtt)]
-        num_observed_rtts += 1
+    num_observed_rtts = len(observed)
+else:
+    with open(observed_filename) as observed_file:
+        csv_reader = csv.reader(observed_file, delimiter=',')
+        for row in csv_reader:
+            if row[6] == "0" or row[7] == "0": # seq, ack (a switch name may follow)
+                continue
+            key = row_to_key(row)
+            rtt = int(row[0])
+            register_index_of_rtt = int(row[1])
+            if key in observed_rtts:
+                observed_rtts[key].append((rtt, register_index_of_rtt))
+            else:
+                observed_rtts[key] = [(rtt, register_index_of_rtt)]
+            num_observed_rtts += 1
 
 # Iterate over actual CSV
 missed_rows = []
@@ -39,8 +72,10 @@ with open(actual_filename + ".marked.csv", "w") as marked_actual_file:
     with open(actual_filename) as actual_file:
         csv_reader = csv.reader(actual_file, delimiter=',')
         for row in csv_reader:
-            key = ",".join(row[2:8])
+            key = row_to_key(row)
             actual_rtt = float(row[0])
+            if timestamp_modulus is not None:
+                actual_rtt %= timestamp_modulus
             marked_actual_file.write(",".join(row) + ",")
             if key in observed_rtts and len(observed_rtts[key]) > 0:
                 best_error = float("inf")
@@ -64,7 +99,7 @@ for key, rtts_and_register_indices_of_rtt in observed_rtts.items():
         bogus_rows.append("%d,%d,%s" % (
             rtt_and_register_index_of_rtt[0],
             rtt_and_register_index_of_rtt[1], 
-            key
+            key_to_string(key)
         ))
 
 # Print statistics: miss rate, bogus rate, observed count, MSE, bogus rows
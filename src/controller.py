@@ -3,16 +3,103 @@
 
 # Usage: ./legacy-controller.py -r > path/to/observed_rtts_filename.csv
 # Output columns:
-# RTT (microsec), register index of RTT, sip (of ACK packet), dip, spt, dpt, seq, ack
+# RTT (microsec), register index of RTT, sip (of ACK packet), dip, spt, dpt, seq, ack,
+# percent of flows sampled (100 - filter_percent) when the RTT was measured
+# With --topology, every switch in the topology is polled at once, and each row ends with
+# one more column: the name of the switch that observed the RTT
 
 from __future__ import print_function
-import sys, time, pexpect, re, socket, argparse, math
+import sys, os, time, pexpect, re, socket, struct, argparse, math, bisect, collections, json, threading, pickle
+import contextlib
+import numpy
+from Queue import Queue, Empty
+from quantile_sketch import KLLSketch, SlidingWindowSketch
+from observed_rtts import OBSERVED_RTT_DTYPE, SWITCH_OBSERVED_RTT_DTYPE, ObservedRttWriter
+from metrics import MetricsRegistry, start_metrics_server
+from flow_stats import FlowTable
+from rollups import Rollups, open_rollup_writers
+from rtt_export import pack_datagrams
+
+# runtime_CLI.py (and the bmv2 Thrift bindings it pulls in) live in ../utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
 
 TABLE_SIZE = 120
-NUM_TABLES = 2
+# Most tables program.p4 has probes for (MAX_MULTI_TABLE)
+MAX_NUM_TABLES = 8
+# Tables of program.p4 compiled with RESIZABLE_TABLES_FLAG are this far apart, whatever their size
+MAX_TABLE_SIZE = 1024
 
 INITIAL_FILTER_PERCENT = 0
 
+DEFAULT_THRIFT_PORT = 9090
+DEFAULT_GRPC_PORT = 50051
+
+# How long the switch may hold, and how many RTTs it may put in, one digest list
+DIGEST_MAX_TIMEOUT_NS = 10000000
+DIGEST_MAX_LIST_SIZE = 128
+
+# Size of the RTT ring in program.p4 (current_rtt_index wraps at this)
+MAX_NUM_RTTS = 1024
+# rtt_count in program.p4 counts every RTT written to the ring, wrapping at 2^32
+RTT_COUNT_MODULUS = 2 ** 32
+# Banks of RTT registers in program.p4 with DOUBLE_BANK_FLAG (bank b starts at slot b * MAX_NUM_RTTS)
+NUM_BANKS = 2
+# Upper bounds (microseconds) of the RTT histogram buckets; the last bucket is unbounded
+RTT_HISTOGRAM_BOUNDS = [100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000,
+    200000, 500000, 1000000, 2000000, 5000000, 10000000]
+# Most filter_percent may be raised to by --sample-budget (at least 1% of flows stay sampled)
+MAX_FILTER_PERCENT = 99
+# Most the sampled fraction may grow by in one poll once load is back under budget
+SAMPLING_RECOVERY = 1.25
+# Weight of the previous rate estimate when the RTT rate drops (adaptive polling)
+RTT_RATE_SMOOTHING = 0.8
+# Past this many new slots, reading whole registers is cheaper than one read per slot
+MAX_SLOTS_READ_INDIVIDUALLY = 16
+
+# Registers holding the RTTs (and their packet fields) in the order they are computed
+RTT_REGISTERS = [
+    'rtts',
+    'register_indices_of_rtts',
+    'src_ips_of_rtts',
+    'dst_ips_of_rtts',
+    'src_ports_of_rtts',
+    'dst_ports_of_rtts',
+    'seq_nos_of_rtts',
+    'ack_nos_of_rtts'
+]
+
+# Packed layout (program.p4 with PACKED_RTTS_FLAG): the same fields, in bits, concatenated
+# into one record and split over RTT_RECORD_WORDS consecutive 63-bit words of rtt_records
+RTT_RECORD_FIELDS = [
+    ('rtts', 48),
+    ('register_indices_of_rtts', 32),
+    ('src_ips_of_rtts', 32),
+    ('dst_ips_of_rtts', 32),
+    ('src_ports_of_rtts', 16),
+    ('dst_ports_of_rtts', 16),
+    ('seq_nos_of_rtts', 32),
+    ('ack_nos_of_rtts', 32)
+]
+RTT_RECORD_WORDS = 4
+RTT_RECORD_WORD_BITS = 63
+
+# A switch polled by the controller; index is its position in the topology
+Switch = collections.namedtuple('Switch', ['index', 'name', 'thrift_port', 'grpc_port'])
+
+# Held while printing or writing observed RTTs, so switches polled at once don't interleave
+output_lock = threading.Lock()
+# Set to stop every poll_switch thread after its current poll
+stop_polling = threading.Event()
+# Why each switch that stopped early stopped (a ControllerError), for main to report once polling ends
+switch_errors = []
+
+# Phases of a poll timed by --timing-interval and --timing-trace, in the order they happen
+POLL_PHASES = ['read', 'reset', 'parse', 'aggregate', 'occupancy', 'tune', 'emit']
+# Percentiles of phase durations in timing reports
+TIMING_PERCENTILES = [0.5, 0.9, 0.99]
+# Most polls a timing report covers (the most recent ones)
+MAX_TIMED_POLLS = 10000
+
 ## http://code.activestate.com/recipes/511478/
 def percentile(N, percent, key=lambda x:x):
     """
@@ -34,8 +121,80 @@ def percentile(N, percent, key=lambda x:x):
     return d0+d1
 
 def int_to_ip(ip):
-    # Convert int to IP address: https://stackoverflow.com/questions/5619685/    
-    return socket.inet_ntoa(hex(ip)[2:].zfill(8).decode('hex'))
+    # Convert int to IP address (ip may be a long when it comes out of a NumPy array)
+    return socket.inet_ntoa(struct.pack('!I', ip))
+
+class PhaseTimer(object):
+    """Wall time spent in each of the POLL_PHASES during the current poll (a phase started inside
+    another pauses it), and the durations of the polls since the last report"""
+
+    def __init__(self):
+        self.durations = collections.OrderedDict((phase, 0.0) for phase in POLL_PHASES)
+        self.recent_durations = dict((phase, collections.deque(maxlen=MAX_TIMED_POLLS)) for phase in POLL_PHASES)
+        self.current_phase = None
+        self.phase_start = None
+
+    def start_poll(self):
+        for phase in POLL_PHASES:
+            self.durations[phase] = 0.0
+
+    def end_poll(self):
+        self.begin(None)
+        for phase in POLL_PHASES:
+            self.recent_durations[phase].append(self.durations[phase])
+
+    def begin(self, name):
+        # Ends the phase being timed, if any, and starts timing name (unless None)
+        now = time.time()
+        if self.current_phase is not None:
+            self.durations[self.current_phase] += now - self.phase_start
+        self.current_phase, self.phase_start = name, now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        outer_phase = self.current_phase
+        now = time.time()
+        if outer_phase is not None:
+            self.durations[outer_phase] += now - self.phase_start
+        self.current_phase, self.phase_start = name, now
+        try:
+            yield
+        finally:
+            now = time.time()
+            self.durations[name] += now - self.phase_start
+            self.current_phase, self.phase_start = outer_phase, now
+
+    def report(self):
+        # "phase p50/p90/p99/max, ..." in milliseconds over the polls since the last report
+        fields = []
+        for phase in POLL_PHASES:
+            durations = sorted(self.recent_durations[phase])
+            self.recent_durations[phase].clear()
+            if durations:
+                fields.append(phase + " " + "/".join("%.2f" % (1000 * value)
+                    for value in [percentile(durations, p) for p in TIMING_PERCENTILES] + [durations[-1]]))
+        return ", ".join(fields)
+
+class NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_PHASE = NoPhase()
+
+# PhaseTimer of the poll running in this thread (None when polls aren't timed)
+poll_timers = threading.local()
+
+def timed_phase(name):
+    timer = getattr(poll_timers, 'timer', None)
+    return NO_PHASE if timer is None else timer.phase(name)
+
+def begin_phase(name):
+    timer = getattr(poll_timers, 'timer', None)
+    if timer is not None:
+        timer.begin(name)
 
 def run_thrift_command(thrift, command):
     if command is not None:
@@ -44,114 +203,998 @@ def run_thrift_command(thrift, command):
     return thrift.before
 
 def parse_thrift_register(thrift_output):
-    return [int(rtt_string) for rtt_string in re.findall(r'\d+', thrift_output)]
+    with timed_phase('parse'):
+        return [int(rtt_string) for rtt_string in re.findall(r'\d+', thrift_output)]
 
-def main(args):
-    rtts = []
-    thrift = pexpect.spawn('python ../utils/runtime_CLI.py')
-    run_thrift_command(thrift, None) # Cue up the command line interface
-    # Initialize tuning parameters
-    run_thrift_command(thrift, 'register_write latency_threshold 0 ' + str(args.initial_stale_threshold))
-    run_thrift_command(thrift, 'register_write filter_percent 0 ' + str(INITIAL_FILTER_PERCENT))
-    if args.reset:
-        run_thrift_command(thrift, 'register_reset timestamps')
-        run_thrift_command(thrift, 'register_reset keys')
-    while True:
-        time.sleep(args.sleep)
-        # Issue read commands
-        current_rtts_thrift_output = run_thrift_command(thrift, 'register_read rtts')
-        current_register_indices_of_rtts_thrift_output = \
-            run_thrift_command(thrift, 'register_read register_indices_of_rtts')
-        current_src_ips_of_rtts_thrift_output = run_thrift_command(thrift, 'register_read src_ips_of_rtts')
-        current_dst_ips_of_rtts_thrift_output = run_thrift_command(thrift, 'register_read dst_ips_of_rtts')
-        current_src_ports_of_rtts_thrift_output = run_thrift_command(thrift, 'register_read src_ports_of_rtts')
-        current_dst_ports_of_rtts_thrift_output = run_thrift_command(thrift, 'register_read dst_ports_of_rtts')
-        current_seq_nos_of_rtts_thrift_output = run_thrift_command(thrift, 'register_read seq_nos_of_rtts')
-        current_ack_nos_of_rtts_thrift_output = run_thrift_command(thrift, 'register_read ack_nos_of_rtts')
-        current_timestamps_thrift_output = run_thrift_command(thrift, 'register_read timestamps')
-        # Issue reset commands
-        run_thrift_command(thrift, 'register_reset rtts')
-        run_thrift_command(thrift, 'register_reset register_indices_of_rtts')
-        run_thrift_command(thrift, 'register_reset src_ips_of_rtts')
-        run_thrift_command(thrift, 'register_reset dst_ips_of_rtts')
-        run_thrift_command(thrift, 'register_reset src_ports_of_rtts')
-        run_thrift_command(thrift, 'register_reset dst_ports_of_rtts')
-        run_thrift_command(thrift, 'register_reset seq_nos_of_rtts')
-        run_thrift_command(thrift, 'register_reset ack_nos_of_rtts')
-        run_thrift_command(thrift, 'register_reset current_rtt_index')
-        # Process new RTTs
-        new_rtts_etc = []
-        current_rtts = parse_thrift_register(current_rtts_thrift_output)
-        current_register_indices_of_rtts = \
-            parse_thrift_register(current_register_indices_of_rtts_thrift_output)
-        current_src_ips_of_rtts = parse_thrift_register(current_src_ips_of_rtts_thrift_output)
-        current_dst_ips_of_rtts = parse_thrift_register(current_dst_ips_of_rtts_thrift_output)
-        current_src_ports_of_rtts = parse_thrift_register(current_src_ports_of_rtts_thrift_output)
-        current_dst_ports_of_rtts = parse_thrift_register(current_dst_ports_of_rtts_thrift_output)
-        current_seq_nos_of_rtts = parse_thrift_register(current_seq_nos_of_rtts_thrift_output)
-        current_ack_nos_of_rtts = parse_thrift_register(current_ack_nos_of_rtts_thrift_output)
-        for i in range(len(current_rtts)):
-            if current_rtts[i] > 0 and current_register_indices_of_rtts[i] < TABLE_SIZE * NUM_TABLES:
-            # if current_rtts[i] > 0 and current_register_indices_of_rtts[i] < TABLE_SIZE * NUM_TABLES \
-            #     and current_rtts[i] <= MAX_REPORTABLE_RTT:
-                rtts.append(current_rtts[i])
-                new_rtts_etc.append((
-                    current_rtts[i],
-                    current_register_indices_of_rtts[i],
-                    int_to_ip(current_src_ips_of_rtts[i]),
-                    int_to_ip(current_dst_ips_of_rtts[i]),
-                    current_src_ports_of_rtts[i],
-                    current_dst_ports_of_rtts[i],
-                    current_seq_nos_of_rtts[i],
-                    current_ack_nos_of_rtts[i]
-                ))
-        # Check the occupancies of timestamp register
-        current_timestamps = parse_thrift_register(current_timestamps_thrift_output)
-        occupancies = []
-        for i in range(NUM_TABLES):
-            occupancy = len([t for t in current_timestamps[(i*TABLE_SIZE):((i+1)*TABLE_SIZE)] if t != 0])
-            occupancies.append(occupancy)
-        # Autotuning
+class CLIBackend(object):
+    """Register access by driving a runtime_CLI.py child process and scraping its output"""
+
+    def __init__(self, thrift_port=DEFAULT_THRIFT_PORT):
+        self.thrift = pexpect.spawn('python ../utils/runtime_CLI.py --thrift-port ' + str(thrift_port))
+        run_thrift_command(self.thrift, None) # Cue up the command line interface
+
+    def register_read(self, name):
+        return parse_thrift_register(run_thrift_command(self.thrift, 'register_read ' + name))
+
+    def register_read_index(self, name, index):
+        thrift_output = run_thrift_command(self.thrift, 'register_read %s %d' % (name, index))
+        return parse_thrift_register(thrift_output.split('=', 1)[1])[0] # Skip "name[index]"
+
+    def register_write(self, name, index, value):
+        run_thrift_command(self.thrift, 'register_write %s %d %d' % (name, index, value))
+
+    def register_reset(self, name):
+        run_thrift_command(self.thrift, 'register_reset ' + name)
+
+    def close(self):
+        self.thrift.close()
+
+class ThriftBackend(object):
+    """Register access over one in-process Thrift connection (same client runtime_CLI.py uses)"""
+
+    def __init__(self, thrift_port=DEFAULT_THRIFT_PORT, thrift_ip='localhost'):
+        import runtime_CLI
+        self.client = runtime_CLI.thrift_connect(thrift_ip, thrift_port,
+            [("standard", runtime_CLI.Standard.Client)])[0]
+
+    def register_read(self, name):
+        return [int(value) for value in self.client.bm_register_read_all(0, name)]
+
+    def register_read_index(self, name, index):
+        return int(self.client.bm_register_read(0, name, index))
+
+    def register_write(self, name, index, value):
+        self.client.bm_register_write(0, name, index, value)
+
+    def register_reset(self, name):
+        self.client.bm_register_reset(0, name)
+
+    def close(self):
+        pass
+
+BACKENDS = {
+    'cli': CLIBackend,
+    'thrift': ThriftBackend
+}
+
+# Registers only the controller writes (its tuning parameters); replays serve them from the replay's own writes
+CONTROL_REGISTERS = ['latency_threshold', 'filter_percent', 'active_table_size', 'active_num_tables']
+
+class RecordingBackend(object):
+    """Passes register access through to another backend, appending every read and write
+    (with the time it was made) to a file, one JSON object per line. The first line holds
+    the settings the reads depend on (which drain, and whether packed)"""
+
+    def __init__(self, backend, filename, settings):
+        self.backend = backend
+        self.file = open(filename, 'w')
+        self.record(settings=settings)
+
+    def record(self, **entry):
+        entry['time'] = time.time()
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def register_read(self, name):
+        value = self.backend.register_read(name)
+        self.record(read=name, index=None, value=value)
+        return value
+
+    def register_read_index(self, name, index):
+        value = self.backend.register_read_index(name, index)
+        self.record(read=name, index=index, value=value)
+        return value
+
+    def register_write(self, name, index, value):
+        self.backend.register_write(name, index, value)
+        self.record(write=name, index=index, value=value)
+
+    def register_reset(self, name):
+        self.backend.register_reset(name)
+        self.record(reset=name)
+
+    def close(self):
+        self.backend.close()
+        self.file.close()
+
+class ReplayFinished(Exception):
+    # Raised with the read the recording has no more of, and how many other reads it still has
+    def __init__(self, read, num_unread):
+        Exception.__init__(self, read, num_unread)
+        self.read = read
+        self.num_unread = num_unread
+
+class ControllerError(Exception):
+    # A switch can't be polled as asked; main reports it and exits
+    pass
+
+class ReplayBackend(object):
+    """Serves the reads of a RecordingBackend file in order, as fast as they are asked for.
+    Time is the recorded time of the last read served and sleeping takes none, so a replay
+    polls exactly when the recording did. Tuning parameters (CONTROL_REGISTERS) are kept locally,
+    so a different tuning policy sees its own writes; everything else the data plane would have
+    done differently under that policy is not replayed."""
+
+    def __init__(self, filename, settings):
+        self.reads = collections.defaultdict(collections.deque)
+        self.control_registers = collections.defaultdict(dict)
+        self.now = None
+        with open(filename) as recording:
+            for line in recording:
+                entry = json.loads(line)
+                if self.now is None:
+                    self.now = entry['time']
+                # Other settings make other reads, which the recording doesn't have
+                if 'settings' in entry and entry['settings'] != settings:
+                    raise ControllerError("%s was recorded with -d %s%s; replay it the same way" % (filename,
+                        entry['settings']['drain'], ' --packed' if entry['settings']['packed'] else ''))
+                if 'read' in entry and entry['read'] not in CONTROL_REGISTERS:
+                    self.reads[(entry['read'], entry['index'])].append((entry['time'], entry['value']))
+
+    def next_read(self, name, index):
+        reads = self.reads[(name, index)]
+        if not reads:
+            raise ReplayFinished(name if index is None else '%s[%d]' % (name, index),
+                sum(len(reads) for reads in self.reads.values()))
+        self.now, value = reads.popleft()
+        return value
+
+    def register_read(self, name):
+        if name in CONTROL_REGISTERS:
+            return [self.control_registers[name].get(0, 0)]
+        return self.next_read(name, None)
+
+    def register_read_index(self, name, index):
+        if name in CONTROL_REGISTERS:
+            return self.control_registers[name].get(index, 0)
+        return self.next_read(name, index)
+
+    def register_write(self, name, index, value):
+        if name in CONTROL_REGISTERS:
+            self.control_registers[name][index] = value
+
+    def register_reset(self, name):
+        if name in CONTROL_REGISTERS:
+            self.control_registers[name].clear()
+
+    def close(self):
+        pass
+
+    # Clock of the replay, standing in for the time module
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        pass
+
+def unpack_rtt_records(words):
+    # Slice each field out of the record words of all samples at once, one word-sized piece at a time
+    with timed_phase('parse'):
+        return unpack_rtt_record_words(words)
+
+def unpack_rtt_record_words(words):
+    words = numpy.array(words, dtype=numpy.uint64).reshape(-1, RTT_RECORD_WORDS)
+    columns = {}
+    start = 0
+    for name, width in RTT_RECORD_FIELDS:
+        column = numpy.zeros(len(words), dtype=numpy.uint64)
+        end = start + width
+        while start < end:
+            word, bit = divmod(start, RTT_RECORD_WORD_BITS)
+            piece_width = min(end - start, RTT_RECORD_WORD_BITS - bit)
+            piece = words[:, word] >> numpy.uint64(RTT_RECORD_WORD_BITS - bit - piece_width)
+            piece &= numpy.uint64((1 << piece_width) - 1)
+            column = (column << numpy.uint64(piece_width)) | piece
+            start += piece_width
+        columns[name] = [int(value) for value in column]
+    return columns
+
+def read_rtt_registers(backend, packed=False):
+    if packed:
+        return unpack_rtt_records(backend.register_read('rtt_records'))
+    return dict((name, backend.register_read(name)) for name in RTT_REGISTERS)
+
+def reset_rtt_registers(backend, packed=False):
+    for name in (['rtt_records'] if packed else RTT_REGISTERS):
+        backend.register_reset(name)
+    backend.register_reset('current_rtt_index')
+
+def ring_slots(start, count):
+    # count slots from start, oldest first, following the % MAX_NUM_RTTS wrap
+    return [(start + i) % MAX_NUM_RTTS for i in range(count)]
+
+def read_rtt_slots(backend, slots, packed=False):
+    if len(slots) > MAX_SLOTS_READ_INDIVIDUALLY:
+        rtt_registers = read_rtt_registers(backend, packed)
+        return dict((name, [values[slot] for slot in slots]) for name, values in rtt_registers.items())
+    if packed:
+        return unpack_rtt_records([backend.register_read_index('rtt_records', slot * RTT_RECORD_WORDS + word)
+            for slot in slots for word in range(RTT_RECORD_WORDS)])
+    return dict((name, [backend.register_read_index(name, slot) for slot in slots]) for name in RTT_REGISTERS)
+
+class RingDrain(object):
+    """Bookkeeping shared by the drains that read the RTT ring: rtt_count tells how many RTTs
+    the data plane wrote since the last drain, and how many of those were lost unread"""
+
+    # Attributes a warm restart needs to carry on where the drain left off
+    checkpointed = ['rtt_count']
+
+    def __init__(self, backend, args, state=None):
+        # state is a checkpoint() of the drain to resume, without touching the switch
+        # (unless the switch restarted since)
+        self.backend = backend
+        self.packed = args.packed
+        self.num_new_rtts = 0
+        self.num_lost_rtts = 0
+        if state is None or any(name not in state for name in self.checkpointed):
+            self.resync()
+        else:
+            for name in self.checkpointed:
+                setattr(self, name, state[name])
+            if self.went_back():
+                self.restarted()
+
+    def resync(self):
+        # Start from the switch as it is now
+        self.rtt_count = self.backend.register_read_index('rtt_count', 0)
+
+    def went_back(self):
+        return self.backend.register_read_index('rtt_count', 0) < self.rtt_count
+
+    def restarted(self):
+        # The switch restarted (rtt_count went back): what it wrote since is skipped, not lost
+        print("Switch restarted; resuming from its current RTTs", file=sys.stderr)
+        self.resync()
+
+    def checkpoint(self):
+        return dict((name, getattr(self, name)) for name in self.checkpointed)
+
+    def count_new_rtts(self):
+        # rtt_count now, and how many RTTs were written since the last drain
+        rtt_count = self.backend.register_read_index('rtt_count', 0)
+        num_new_rtts = (rtt_count - self.rtt_count) % RTT_COUNT_MODULUS
+        if num_new_rtts >= RTT_COUNT_MODULUS // 2:
+            # Far more than a poll could see: rtt_count went back rather than wrapped
+            self.restarted()
+            return self.rtt_count, 0
+        return rtt_count, num_new_rtts
+
+class ResetDrain(RingDrain):
+    """Reads the whole RTT ring, then resets it. The ring holds the RTTs written since the last
+    reset, up to the index read first; the others rtt_count saw (written after that index was
+    read, or between the last drain's reads and its reset) were reset unread and count as lost"""
+
+    def drain(self):
+        with timed_phase('read'):
+            current_rtt_index = self.backend.register_read_index('current_rtt_index', 0)
+            rtt_registers = read_rtt_registers(self.backend, self.packed)
+            self.rtt_count, self.num_new_rtts = self.count_new_rtts()
+        with timed_phase('reset'):
+            reset_rtt_registers(self.backend, self.packed)
+        if self.num_new_rtts >= MAX_NUM_RTTS and rtt_registers['rtts'][current_rtt_index] != 0:
+            # The ring went all the way around: every slot is new, the oldest at the index
+            slots = ring_slots(current_rtt_index, MAX_NUM_RTTS)
+        else:
+            slots = ring_slots(0, current_rtt_index)
+        self.num_lost_rtts = max(0, self.num_new_rtts - len(slots))
+        return dict((name, [values[slot] for slot in slots]) for name, values in rtt_registers.items())
+
+class CursorDrain(RingDrain):
+    """Reads only the ring slots written since the last drain, never resetting anything. As the
+    ring is never reset, current_rtt_index moves with rtt_count: the RTT counted as n is in slot
+    (index_offset + n) % MAX_NUM_RTTS, so rtt_count alone tells which slots are new"""
+
+    checkpointed = RingDrain.checkpointed + ['index_offset']
+
+    def resync(self):
+        # Read rtt_count and current_rtt_index with no RTT written in between
+        while True:
+            rtt_count = self.backend.register_read_index('rtt_count', 0)
+            current_rtt_index = self.backend.register_read_index('current_rtt_index', 0)
+            if self.backend.register_read_index('rtt_count', 0) == rtt_count:
+                break
+        self.rtt_count = rtt_count
+        self.index_offset = (current_rtt_index - rtt_count) % MAX_NUM_RTTS
+
+    def drain(self):
+        with timed_phase('read'):
+            rtt_count, self.num_new_rtts = self.count_new_rtts()
+            # Only the last MAX_NUM_RTTS written are still in the ring, the oldest first
+            num_readable = min(self.num_new_rtts, MAX_NUM_RTTS)
+            first = (rtt_count - num_readable) % RTT_COUNT_MODULUS
+            slots = ring_slots((self.index_offset + first) % MAX_NUM_RTTS, num_readable)
+            rtt_registers = read_rtt_slots(self.backend, slots, self.packed)
+            # RTTs written while reading may have overwritten the oldest slots read
+            num_written = (self.backend.register_read_index('rtt_count', 0) - rtt_count) % RTT_COUNT_MODULUS
+            num_overwritten = min(num_readable, max(0, num_readable + num_written - MAX_NUM_RTTS))
+        self.rtt_count = rtt_count
+        self.num_lost_rtts = self.num_new_rtts - num_readable + num_overwritten
+        return dict((name, values[num_overwritten:]) for name, values in rtt_registers.items())
+
+class BankDrain(RingDrain):
+    """Flips bank_select, then reads the bank the data plane was writing (DOUBLE_BANK_FLAG).
+    bank_rtt_counts tells how many RTTs went into that bank since it was last drained (RTTs
+    written into the other bank since the flip don't count)"""
+
+    checkpointed = ['bank_rtt_counts', 'active_bank']
+
+    def resync(self):
+        self.bank_rtt_counts = [self.backend.register_read_index('bank_rtt_counts', bank) for bank in range(NUM_BANKS)]
+        # Start with every bank empty and the data plane writing bank 0
+        self.active_bank = 0
+        self.backend.register_write('bank_select', 0, self.active_bank)
+        for bank in range(NUM_BANKS):
+            self.backend.register_write('current_rtt_index', bank, 0)
+
+    def went_back(self):
+        return any(self.backend.register_read_index('bank_rtt_counts', bank) < bank_rtt_count
+            for bank, bank_rtt_count in enumerate(self.bank_rtt_counts))
+
+    def drain(self):
+        idle_bank = self.active_bank
+        self.active_bank = (self.active_bank + 1) % NUM_BANKS
+        with timed_phase('reset'):
+            self.backend.register_write('bank_select', 0, self.active_bank)
+        with timed_phase('read'):
+            # Once idle, the bank's count and index stay put
+            bank_rtt_count = self.backend.register_read_index('bank_rtt_counts', idle_bank)
+            self.num_new_rtts = (bank_rtt_count - self.bank_rtt_counts[idle_bank]) % RTT_COUNT_MODULUS
+            if self.num_new_rtts >= RTT_COUNT_MODULUS // 2:
+                self.restarted() # The count went back rather than wrapped
+                self.num_new_rtts = self.num_lost_rtts = 0
+                return dict((name, []) for name in RTT_REGISTERS)
+            current_rtt_index = self.backend.register_read_index('current_rtt_index', idle_bank)
+            if self.num_new_rtts >= MAX_NUM_RTTS:
+                slots = ring_slots(current_rtt_index, MAX_NUM_RTTS) # The bank wrapped around
+            else:
+                slots = ring_slots(0, current_rtt_index)
+            rtt_registers = read_rtt_slots(self.backend,
+                [idle_bank * MAX_NUM_RTTS + slot for slot in slots], self.packed)
+        with timed_phase('reset'):
+            self.backend.register_write('current_rtt_index', idle_bank, 0)
+        self.bank_rtt_counts[idle_bank] = bank_rtt_count
+        self.num_lost_rtts = max(0, self.num_new_rtts - MAX_NUM_RTTS)
+        return rtt_registers
+
+class DigestDrain(object):
+    """Collects the RTTs the switch pushes as P4Runtime digests (DIGEST_FLAG)"""
+
+    def __init__(self, backend, args, state=None):
+        import p4runtime_lib.bmv2, p4runtime_lib.helper
+        from p4runtime_lib.convert import decodeNum
+        self.timeout = args.sleep
+        self.num_new_rtts = 0
+        self.num_lost_rtts = 0
+        self.digests = Queue()
+        p4info_helper = p4runtime_lib.helper.P4InfoHelper(args.p4info)
+        self.switch = p4runtime_lib.bmv2.Bmv2SwitchConnection(name='controller',
+            address='127.0.0.1:%d' % args.grpc_port, device_id=0)
+        self.switch.MasterArbitrationUpdate()
+        self.switch.WriteDigestEntry(p4info_helper.get_digests_id('rtt_digest_t'),
+            max_timeout_ns=DIGEST_MAX_TIMEOUT_NS, max_list_size=DIGEST_MAX_LIST_SIZE)
+        def on_digest_list(digest_list):
+            # Digest members are in RTT_REGISTERS order
+            self.digests.put([[decodeNum(member.bitstring) for member in data.struct.members]
+                for data in digest_list.data])
+        self.switch.StartStreamListener(on_digest_list)
+
+    def drain(self):
+        # Block until the first digest list arrives (or timeout), then take every list already queued
+        samples = []
+        try:
+            samples.extend(self.digests.get(timeout=self.timeout))
+            while True:
+                samples.extend(self.digests.get_nowait())
+        except Empty:
+            pass
+        self.num_new_rtts = len(samples)
+        return dict((name, [sample[i] for sample in samples]) for i, name in enumerate(RTT_REGISTERS))
+
+    def checkpoint(self):
+        return {} # The switch keeps no state for the controller to carry on from
+
+DRAINS = {
+    'reset': ResetDrain,
+    'cursor': CursorDrain,
+    'banks': BankDrain,
+    'digest': DigestDrain
+}
+
+class RttStats(object):
+    """Running SLA counters and RTT histogram"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.num_rtts = 0
+        self.num_exceeding_threshold = 0
+        self.sum_of_rtts = 0
+        # histogram[i] counts RTTs <= RTT_HISTOGRAM_BOUNDS[i] (and above the previous bound)
+        self.histogram = [0] * (len(RTT_HISTOGRAM_BOUNDS) + 1)
+
+    def update(self, rtts):
+        for rtt in rtts:
+            self.num_rtts += 1
+            self.sum_of_rtts += rtt
+            if rtt > self.threshold:
+                self.num_exceeding_threshold += 1
+            self.histogram[bisect.bisect_left(RTT_HISTOGRAM_BOUNDS, rtt)] += 1
+
+    @property
+    def num_at_or_below_threshold(self):
+        return self.num_rtts - self.num_exceeding_threshold
+
+    @property
+    def average_rtt(self):
+        return self.sum_of_rtts // self.num_rtts if self.num_rtts > 0 else None
+
+class OccupancyTuner(object):
+    """PI controller steering latency_threshold so the tables stay about target_fill full (all
+    tables together, as in "Occupancies of registers"). A longer threshold keeps timestamps fresh
+    longer, so later packets spill into the next table (or are dropped); a shorter one lets them
+    replace stale timestamps. Anti-windup: the integral stops growing while the threshold is
+    pinned at a bound and the error pushes it further out."""
+
+    def __init__(self, target_fill, kp, ki, initial_threshold, min_threshold, max_threshold):
+        self.target_fill = target_fill
+        self.kp = kp
+        self.ki = ki
+        self.initial_threshold = initial_threshold
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.integral = 0.0
+        self.last_time = None
+
+    def update(self, table_fill, now):
+        # Returns the new threshold (microseconds); table_fill is the fraction of table slots occupied
+        error = self.target_fill - table_fill
+        dt = 0.0 if self.last_time is None else now - self.last_time
+        self.last_time = now
+        integral = self.integral + error * dt
+        threshold = self.initial_threshold + self.kp * error + self.ki * integral
+        if self.ki and ((threshold > self.max_threshold and error > 0) or (threshold < self.min_threshold and error < 0)):
+            # Integrate only up to where the threshold reaches the bound
+            bound = self.max_threshold if error > 0 else self.min_threshold
+            integral_at_bound = (bound - self.initial_threshold - self.kp * error) / self.ki
+            integral = min(max(integral_at_bound, min(self.integral, integral)), max(self.integral, integral))
+            threshold = self.initial_threshold + self.kp * error + self.ki * integral
+        self.integral = integral
+        return int(min(self.max_threshold, max(self.min_threshold, threshold)))
+
+class SamplingTuner(object):
+    """Chooses filter_percent so that measured (sampled) RTTs per second and the fill of the tables
+    stay within their budgets; both shrink with the sampled fraction. (The RTT ring doesn't: every
+    ACK is written to it, sampled or not, so its fill is left to the poll interval, -f.) Pressure is
+    the larger ratio of a measurement to its budget: over 1, the sampled fraction is divided by it
+    at once; under 1, it grows back by at most SAMPLING_RECOVERY per poll."""
+
+    def __init__(self, rtt_budget, table_fill_budget, filter_percent):
+        self.rtt_budget = rtt_budget
+        self.table_fill_budget = table_fill_budget
+        self.filter_percent = filter_percent
+
+    def update(self, sampled_rtt_rate, table_fill):
+        # Returns the new filter_percent
+        pressure = max(sampled_rtt_rate / self.rtt_budget, table_fill / self.table_fill_budget)
+        sampled = (100 - self.filter_percent) / 100.0
+        if pressure > 1:
+            sampled /= pressure
+        else:
+            sampled = min(sampled / max(pressure, 1e-6), sampled * SAMPLING_RECOVERY)
+        filter_percent = min(MAX_FILTER_PERCENT, max(0, int(round(100 * (1 - sampled)))))
+        if pressure > 1 and filter_percent == self.filter_percent:
+            filter_percent = min(MAX_FILTER_PERCENT, filter_percent + 1) # Don't get stuck rounding
+        self.filter_percent = filter_percent
+        return filter_percent
+
+def flow_name(flow_key):
+    src_ip, dst_ip, src_port, dst_port = flow_key
+    return "%s:%d -> %s:%d" % (int_to_ip(src_ip), src_port, int_to_ip(dst_ip), dst_port)
+
+def observed_rtt_batch(rtt_registers, sampling_percent, table_end):
+    # The drained RTTs that are real measurements (misses point into the drop table), as one array;
+    # table_end is the register index past the last table in use
+    with timed_phase('parse'):
+        return observed_rtt_array(rtt_registers, sampling_percent, table_end)
+
+def observed_rtt_array(rtt_registers, sampling_percent, table_end):
+    batch = numpy.zeros(len(rtt_registers['rtts']), dtype=OBSERVED_RTT_DTYPE)
+    for column, name in zip(OBSERVED_RTT_DTYPE.names, RTT_REGISTERS):
+        batch[column] = rtt_registers[name]
+    batch['sampling_percent'] = sampling_percent
+    return batch[(batch['rtt'] > 0) & (batch['register_index'] < table_end)]
+    # return batch[(batch['rtt'] > 0) & (batch['register_index'] < table_end) \
+    #     & (batch['rtt'] <= MAX_REPORTABLE_RTT)]
+
+def csv_fields(observed_rtt):
+    # Fields come as numpy integers or, on Python 2, longs; int() keeps the L off printed tuples
+    rtt, register_index, src_ip, dst_ip, src_port, dst_port, seq, ack, sampling_percent = observed_rtt
+    return (int(rtt), int(register_index), int_to_ip(src_ip), int_to_ip(dst_ip), int(src_port), int(dst_port),
+        int(seq), int(ack), int(sampling_percent))
+
+class CSVSink(object):
+    """Prints observed RTTs to stdout, one CSV row each"""
+
+    def write(self, new_rtts, switch=None):
+        for new_rtt in new_rtts.tolist():
+            if switch is None:
+                print("%d,%d,%s,%s,%d,%d,%d,%d,%d" % csv_fields(new_rtt))
+            else:
+                print("%d,%d,%s,%s,%d,%d,%d,%d,%d,%s" % (csv_fields(new_rtt) + (switch.name,)))
+
+    def close(self):
+        sys.stdout.flush()
+
+class BinarySink(object):
+    """Appends observed RTTs to a binary file (see observed_rtts.py), one batch per poll.
+    With rotate_seconds, the file is moved to filename.1 (replacing the one before) that often,
+    so only the last rotate_seconds to 2 * rotate_seconds of RTTs are kept"""
+
+    def __init__(self, filename, switches=None, rotate_seconds=None):
+        self.filename = filename
+        self.switches = switches
+        self.rotate_seconds = rotate_seconds
+        self.open_writer()
+
+    def open_writer(self):
+        if self.switches is None:
+            self.writer = ObservedRttWriter(self.filename)
+        else:
+            # Records also hold the index of their switch; the header lists the switch names
+            self.writer = ObservedRttWriter(self.filename, SWITCH_OBSERVED_RTT_DTYPE,
+                [switch.name for switch in self.switches])
+        self.opened = time.time()
+
+    def write(self, new_rtts, switch=None):
+        if self.rotate_seconds is not None and time.time() - self.opened >= self.rotate_seconds:
+            self.writer.close()
+            os.rename(self.filename, self.filename + '.1')
+            self.open_writer()
+        if switch is not None:
+            tagged_rtts = numpy.zeros(len(new_rtts), dtype=SWITCH_OBSERVED_RTT_DTYPE)
+            for name in new_rtts.dtype.names:
+                tagged_rtts[name] = new_rtts[name]
+            tagged_rtts['switch'] = switch.index
+            new_rtts = tagged_rtts
+        self.writer.write(new_rtts)
+
+    def close(self):
+        self.writer.close()
+
+class UDPSink(object):
+    """Sends observed RTTs to a collector (such as rtt-collector.py) in the datagrams of rtt_export.py.
+    Sending never blocks: a datagram the socket can't take at once is dropped (and counted), and
+    the collector sees the gap in the sequence numbers"""
+
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.sequence = 0
+        self.num_dropped_datagrams = 0
+
+    def write(self, new_rtts, switch=None):
+        records = numpy.zeros(len(new_rtts), dtype=SWITCH_OBSERVED_RTT_DTYPE)
+        for name in new_rtts.dtype.names:
+            records[name] = new_rtts[name]
+        records['switch'] = 0 if switch is None else switch.index
+        datagrams = pack_datagrams(records, self.sequence)
+        self.sequence = (self.sequence + len(datagrams)) % 2 ** 32
+        for datagram in datagrams:
+            try:
+                self.socket.sendto(datagram, self.address)
+            except socket.error:
+                self.num_dropped_datagrams += 1
+
+    def close(self):
+        self.socket.close()
+
+def count_occupancies(timestamps, args):
+    # Debugging stand-in for table_occupancies: non-empty timestamps per table
+    occupancies = []
+    for i in range(args.num_tables):
+        start = i * args.table_stride
+        occupancy = len([t for t in timestamps[start:(start + args.table_size)] if t != 0])
+        occupancies.append(occupancy)
+    return occupancies
+
+def next_sleep(args, rtt_rate):
+    # Poll often enough that the ring fills to about --target-fill of MAX_NUM_RTTS between polls
+    if args.target_fill is None:
+        return args.sleep
+    if rtt_rate <= 0:
+        return args.max_sleep
+    return min(args.max_sleep, max(args.min_sleep, args.target_fill * MAX_NUM_RTTS / rtt_rate))
+
+def new_stale_sketch(args):
+    # Streaming stand-in for sorting the eligible RTTs on every poll
+    if args.auto_tune_num_recent_rtts:
+        return SlidingWindowSketch(args.auto_tune_num_recent_rtts, k=args.sketch_k)
+    return KLLSketch(args.sketch_k)
+
+def save_checkpoint(filename, checkpoint):
+    # Replace the file only once the new checkpoint is complete
+    with open(filename + '.tmp', 'wb') as checkpoint_file:
+        pickle.dump(checkpoint, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+
+def load_checkpoint(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as checkpoint_file:
+        return pickle.load(checkpoint_file)
+
+def natural_key(name):
+    # Orders s2 before s10, as Mininet does
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+def load_switches(topology_filename):
+    # run_exercise.py starts the switches in name order, numbering Thrift ports from 9090 and
+    # gRPC ports from 50051; a switch in the topology may also set its own thrift_port or grpc_port
+    with open(topology_filename) as topology_file:
+        switches = json.load(topology_file)['switches']
+    return [Switch(index, name,
+            switches[name].get('thrift_port', DEFAULT_THRIFT_PORT + index),
+            switches[name].get('grpc_port', DEFAULT_GRPC_PORT + index))
+        for index, name in enumerate(sorted(switches, key=natural_key))]
+
+def poll_switch(args, sinks, switch=None, metrics=None, rollups=None):
+    # Poll one switch forever; switch is None when the controller runs without --topology
+    if switch is not None:
+        args = argparse.Namespace(**vars(args))
+        args.thrift_port = switch.thrift_port
+        args.grpc_port = switch.grpc_port
+        if args.record is not None:
+            args.record = '%s.%s' % (args.record, switch.name)
+        if args.replay is not None:
+            args.replay = '%s.%s' % (args.replay, switch.name)
+        if args.checkpoint is not None:
+            args.checkpoint = '%s.%s' % (args.checkpoint, switch.name)
+        if args.timing_trace is not None:
+            args.timing_trace = '%s.%s' % (args.timing_trace, switch.name)
+    tag = "" if switch is None else "[%s] " % switch.name
+    # A checkpoint left by an earlier run means a warm restart: carry on from it, leaving the switch as it is
+    # (remove the checkpoint if the switch restarted too: its ring no longer matches)
+    checkpoint = None if args.checkpoint is None else load_checkpoint(args.checkpoint)
+    if checkpoint is not None and (checkpoint['drain'], checkpoint['packed']) != (args.drain, args.packed):
+        raise ControllerError("%s was written with -d %s%s; restart the same way or remove it" % (args.checkpoint,
+            checkpoint['drain'], ' --packed' if checkpoint['packed'] else ''))
+    if checkpoint is not None:
+        print(tag + "Warm restart from", args.checkpoint, file=sys.stderr)
+        stats = checkpoint['stats']
+        flow_table = checkpoint['flow_table']
+    else:
+        stats = RttStats(args.threshold)
+        flow_table = FlowTable(args.max_flows, args.num_slowest_flows, args.flow_sketch_k) if args.max_flows > 0 else None
+    # The reads a poll makes depend on these, so a recording keeps them and a replay must match them
+    recorded_settings = {'drain': args.drain, 'packed': args.packed}
+    if args.replay is not None:
+        backend = ReplayBackend(args.replay, recorded_settings)
+        clock = backend
+    else:
+        backend = BACKENDS[args.backend](args.thrift_port)
+        clock = time
+    if args.record is not None:
+        backend = RecordingBackend(backend, args.record, recorded_settings)
+    # table_occupancies has an entry for each table program.p4 was compiled with (MULTI_TABLE)
+    compiled_num_tables = len(backend.register_read('table_occupancies'))
+    if args.num_tables is None:
+        args.num_tables = compiled_num_tables
+    elif args.num_tables > compiled_num_tables or (args.num_tables < compiled_num_tables and not args.resizable):
+        raise ControllerError("%sprogram.p4 was compiled with %d tables; --num-tables %d needs %s" % (tag, compiled_num_tables,
+            args.num_tables, "a larger MULTI_TABLE" if args.num_tables > compiled_num_tables else "--resizable"))
+    # Each table (and the drop table after them) takes table_stride slots of timestamps
+    compiled_table_stride = len(backend.register_read('timestamps')) // (compiled_num_tables + 1)
+    if compiled_table_stride != args.table_stride:
+        raise ControllerError("%sprogram.p4 was compiled with tables of %d slots; %s" % (tag, compiled_table_stride,
+            "--resizable needs RESIZABLE_TABLES_FLAG" if args.resizable else "pass --table-size %d (or --resizable "
+            "if it has RESIZABLE_TABLES_FLAG)" % compiled_table_stride))
+    if checkpoint is not None and checkpoint['geometry'] != (args.table_size, args.num_tables):
+        raise ControllerError("%s was written with --table-size %d --num-tables %d; restart the same way or remove it" % (
+            args.checkpoint, checkpoint['geometry'][0], checkpoint['geometry'][1]))
+    if checkpoint is not None:
+        # Restore tuning parameters (in case the switch restarted too); tables are left alone, even with -r
+        current_latency_threshold = checkpoint['latency_threshold']
+        current_filter_percent = checkpoint['filter_percent']
+        backend.register_write('latency_threshold', 0, current_latency_threshold)
+        backend.register_write('filter_percent', 0, current_filter_percent)
+        if args.resizable:
+            backend.register_write('active_table_size', 0, args.table_size)
+            backend.register_write('active_num_tables', 0, args.num_tables)
+        drain = DRAINS[args.drain](backend, args, checkpoint['drain_state'])
+    else:
+        # Initialize tuning parameters
+        current_latency_threshold = args.initial_stale_threshold
+        current_filter_percent = INITIAL_FILTER_PERCENT
+        backend.register_write('latency_threshold', 0, current_latency_threshold)
+        backend.register_write('filter_percent', 0, current_filter_percent)
+        # Resize the tables; their timestamps no longer hash to where they are, so clear them too
+        reset = args.reset
+        if args.resizable and (backend.register_read('active_table_size')[0] != args.table_size or
+                backend.register_read('active_num_tables')[0] != args.num_tables):
+            backend.register_write('active_table_size', 0, args.table_size)
+            backend.register_write('active_num_tables', 0, args.num_tables)
+            reset = True
+        if reset:
+            backend.register_reset('timestamps')
+            backend.register_reset('keys')
+            backend.register_reset('table_occupancies')
+        drain = DRAINS[args.drain](backend, args)
+        checkpoint = {}
+    # Tuners missing from the checkpoint (not used before the restart) start afresh
+    if args.auto_tune_stale_threshold_percentile is not None:
+        stale_sketch = checkpoint.get('stale_sketch') or new_stale_sketch(args)
+    if args.target_occupancy is not None:
+        occupancy_tuner = checkpoint.get('occupancy_tuner') or OccupancyTuner(args.target_occupancy, args.kp, args.ki,
+            args.initial_stale_threshold, args.min_stale_rtt, args.max_stale_rtt)
+        occupancy_tuner.last_time = None # Don't integrate over the downtime
+    if args.sample_budget is not None:
+        sampling_tuner = checkpoint.get('sampling_tuner') or SamplingTuner(args.sample_budget,
+            args.table_fill_budget, current_filter_percent)
+    sleep = checkpoint.get('sleep', args.sleep)
+    rtt_rate = 0.0 # RTTs written per second, smoothed (measured afresh after a restart)
+    num_lost_rtts = checkpoint.get('num_lost_rtts', 0)
+    num_polls = checkpoint.get('num_polls', 0)
+    sum_of_poll_durations = checkpoint.get('sum_of_poll_durations', 0.0)
+    last_drain_time = clock.time()
+    last_checkpoint_time = last_drain_time
+    if args.timing_interval is not None or args.timing_trace is not None:
+        timer = poll_timers.timer = PhaseTimer()
+        last_timing_report_time = last_drain_time
+        if args.timing_trace is not None:
+            timing_trace = open(args.timing_trace, 'w')
+            timing_trace.write(",".join(['time'] + POLL_PHASES) + "\n")
+    else:
+        timer = None
+    def checkpoint_state():
+        checkpoint = {
+            'drain': args.drain,
+            'packed': args.packed,
+            'geometry': (args.table_size, args.num_tables),
+            'drain_state': drain.checkpoint(),
+            'latency_threshold': current_latency_threshold,
+            'filter_percent': current_filter_percent,
+            'stats': stats,
+            'flow_table': flow_table,
+            'sleep': sleep,
+            'num_lost_rtts': num_lost_rtts,
+            'num_polls': num_polls,
+            'sum_of_poll_durations': sum_of_poll_durations
+        }
         if args.auto_tune_stale_threshold_percentile is not None:
-            eligible_rtts = rtts
-            if args.auto_tune_num_recent_rtts == 0:
-                eligible_rtts = [x[0] for x in new_rtts_etc]
-            elif args.auto_tune_num_recent_rtts is not None:
-                eligible_rtts = rtts[(-1 * args.auto_tune_num_recent_rtts):]
-            eligible_rtts.sort()
-            new_stale = int(percentile(filter(lambda x: x < args.max_stale_rtt, eligible_rtts),
-                args.auto_tune_stale_threshold_percentile / 100))
-            run_thrift_command(thrift, 'register_write latency_threshold 0 ' + str(new_stale))
-        # Check tuning parameters
-        current_latency_threshold_thrift_output = run_thrift_command(thrift, 'register_read latency_threshold')
-        current_latency_threshold = parse_thrift_register(current_latency_threshold_thrift_output)[0]
-        #current_filter_percent_thrift_output = run_thrift_command(thrift, 'register_read filter_percent')
-        #current_filter_percent = parse_thrift_register(current_filter_percent_thrift_output)[0]
-        # Print statistics
-        if args.threshold > 0:
-            print("--------------------------------------")
-            print("# pkts processed:              " + str(len(rtts)))
-            print("# pkts exceeding threshold:    " + str(len([rtt for rtt in rtts if rtt > args.threshold])))
-            print("# pkts at or below threshold:  " + str(len([rtt for rtt in rtts if rtt <= args.threshold])))
-            if len(rtts) > 0:
-                print("Average RTT:                   " + str(sum(rtts) / len(rtts)))
-            if len(new_rtts_etc) > 0:
-                print("New RTTs and register indices:", new_rtts_etc)
-            print("Occupancies of registers:      " + str(sum(occupancies)), occupancies)
-            print("Stale RTT threshold:           " + str(current_latency_threshold))
-            #print("Filter percent for sampling:   " + str(current_filter_percent))
+            checkpoint['stale_sketch'] = stale_sketch
+        if args.target_occupancy is not None:
+            checkpoint['occupancy_tuner'] = occupancy_tuner
+        if args.sample_budget is not None:
+            checkpoint['sampling_tuner'] = sampling_tuner
+        save_checkpoint(args.checkpoint, checkpoint)
+    # Whether a poll is under way: stopped halfway, its RTTs are drained but not yet counted or written
+    polling = False
+    try:
+        while not stop_polling.is_set():
+            # RTTs pushed by the switch are processed as soon as they arrive; everything else is polled
+            if not isinstance(drain, DigestDrain):
+                clock.sleep(sleep)
+            # Issue read (and, when draining by reset, reset) commands
+            if timer is not None:
+                timer.start_poll()
+            poll_start = time.time()
+            polling = not isinstance(drain, DigestDrain) # Waiting for digests takes none off the queue
+            current_rtt_registers = drain.drain()
+            polling = True
+            if isinstance(drain, DigestDrain):
+                poll_start = time.time() # Waiting for digests isn't part of the poll
+            # Track how fast RTTs arrive, and how many the ring overwrote before they were read
+            drain_time = clock.time()
+            poll_interval = max(drain_time - last_drain_time, 1e-6)
+            current_rtt_rate = drain.num_new_rtts / poll_interval
+            last_drain_time = drain_time
+            # Speed up at once, slow down gradually
+            rtt_rate = max(current_rtt_rate, RTT_RATE_SMOOTHING * rtt_rate + (1 - RTT_RATE_SMOOTHING) * current_rtt_rate)
+            sleep = next_sleep(args, rtt_rate)
+            num_lost_rtts += drain.num_lost_rtts
+            if drain.num_lost_rtts > 0 and args.threshold <= 0:
+                print(tag + "Lost", drain.num_lost_rtts, "RTTs to ring overflow", file=sys.stderr)
+            # Process new RTTs
+            # They were sampled with the filter_percent of the last poll
+            new_rtts = observed_rtt_batch(current_rtt_registers, 100 - current_filter_percent,
+                args.table_stride * args.num_tables)
+            begin_phase('aggregate')
+            stats.update(new_rtts['rtt'].tolist())
+            if flow_table is not None:
+                # Flows are keyed by the 4-tuple of the ACK packet
+                flow_table.update(zip(*[new_rtts[column].tolist() for column in ['src_ip', 'dst_ip', 'src_port', 'dst_port']]),
+                    new_rtts['rtt'].tolist())
+                slowest_flows = flow_table.slowest()
+            else:
+                slowest_flows = []
+            # Check the occupancies of timestamp register
+            begin_phase('occupancy')
+            if args.read_timestamps:
+                occupancies = count_occupancies(backend.register_read('timestamps'), args)
+            else:
+                occupancies = backend.register_read('table_occupancies')[:args.num_tables]
+            table_fill = sum(occupancies) / float(args.table_size * len(occupancies))
+            # Autotuning
+            begin_phase('tune')
+            if args.auto_tune_stale_threshold_percentile is not None:
+                if args.auto_tune_num_recent_rtts == 0:
+                    stale_sketch = new_stale_sketch(args) # Only the last batch counts
+                stale_sketch.update(rtt for rtt in new_rtts['rtt'].tolist() if rtt < args.max_stale_rtt)
+                new_stale = stale_sketch.quantile(args.auto_tune_stale_threshold_percentile / 100.0)
+                if new_stale is not None:
+                    backend.register_write('latency_threshold', 0, int(new_stale))
+            if args.target_occupancy is not None:
+                backend.register_write('latency_threshold', 0, occupancy_tuner.update(table_fill, drain_time))
+            if args.sample_budget is not None:
+                new_filter_percent = sampling_tuner.update(len(new_rtts) / poll_interval, table_fill)
+                if new_filter_percent != current_filter_percent:
+                    backend.register_write('filter_percent', 0, new_filter_percent)
+            # Check tuning parameters
+            current_latency_threshold = backend.register_read('latency_threshold')[0]
+            current_filter_percent = backend.register_read('filter_percent')[0]
+            begin_phase('emit')
+            with output_lock:
+                # Print statistics
+                if args.threshold > 0:
+                    print("--------------------------------------")
+                    if switch is not None:
+                        print("Switch:                        " + switch.name)
+                    print("# pkts processed:              " + str(stats.num_rtts))
+                    print("# pkts exceeding threshold:    " + str(stats.num_exceeding_threshold))
+                    print("# pkts at or below threshold:  " + str(stats.num_at_or_below_threshold))
+                    if stats.num_rtts > 0:
+                        print("Average RTT:                   " + str(stats.average_rtt))
+                        print("RTT histogram (<= µs: count):  " + ", ".join("%s: %d" % (bound, count)
+                            for bound, count in zip(RTT_HISTOGRAM_BOUNDS + ['inf'], stats.histogram) if count > 0))
+                    if flow_table is not None:
+                        print("# flows tracked:               " + str(len(flow_table)),
+                            "(" + str(flow_table.num_evicted) + " evicted)")
+                        for flow_key, flow in slowest_flows:
+                            print("Slow flow (count, min, smoothed, p99, max):", flow_name(flow_key),
+                                flow.count, flow.min_rtt, int(flow.smoothed_rtt), flow.p99_rtt, flow.max_rtt)
+                    if len(new_rtts) > 0:
+                        print("New RTTs and register indices:", [csv_fields(new_rtt) for new_rtt in new_rtts.tolist()])
+                    print("# RTTs lost to ring overflow:  " + str(drain.num_lost_rtts), "(" + str(num_lost_rtts) + " in total)")
+                    print("Occupancies of registers:      " + str(sum(occupancies)), occupancies)
+                    print("Stale RTT threshold:           " + str(current_latency_threshold))
+                    print("Filter percent for sampling:   " + str(current_filter_percent))
+                for sink in sinks:
+                    sink.write(new_rtts, switch)
+                if rollups is not None:
+                    rollups.add(drain_time, new_rtts['rtt'])
+                if args.threshold <= 0 and args.print_register_occupancy:
+                    print(tag + str(occupancies), "(Recorded", stats.num_rtts, "RTTs, lost", num_lost_rtts, "RTTs, stale",
+                        current_latency_threshold, "µs, filter", current_filter_percent, "%,",
+                        "next poll in %.2f s)" % sleep, file=sys.stderr)
+            # Publish telemetry
+            poll_duration = time.time() - poll_start
+            num_polls += 1
+            sum_of_poll_durations += poll_duration
+            if metrics is not None:
+                metrics.update(None if switch is None else switch.name, stats.histogram, stats.sum_of_rtts,
+                    stats.num_rtts, occupancies, current_latency_threshold, poll_duration, num_polls,
+                    sum_of_poll_durations, num_lost_rtts,
+                    [(flow_name(flow_key), flow.smoothed_rtt, flow.p99_rtt, flow.max_rtt) for flow_key, flow in slowest_flows])
+            polling = False
+            # Checkpoint aggregates, tuning state and the drain's place in the ring
+            if args.checkpoint is not None and drain_time - last_checkpoint_time >= args.checkpoint_interval:
+                last_checkpoint_time = drain_time
+                checkpoint_state()
+            # Report how long each phase took
+            if timer is not None:
+                timer.end_poll()
+                if args.timing_trace is not None:
+                    timing_trace.write(",".join(["%.6f" % drain_time] +
+                        ["%.6f" % duration for duration in timer.durations.values()]) + "\n")
+                    timing_trace.flush()
+                if args.timing_interval is not None and drain_time - last_timing_report_time >= args.timing_interval:
+                    last_timing_report_time = drain_time
+                    print(tag + "Poll phases (ms p50/p90/p99/max):", timer.report(), file=sys.stderr)
+    finally:
+        # Checkpoint once more on the way out (between polls), so a restart loses no polls
+        if args.checkpoint is not None and not polling:
+            checkpoint_state()
+
+def run_switch(args, sinks, switch=None, metrics=None, rollup_writers=None):
+    # poll_switch until it is stopped, fails, or a replay runs out of reads, then write the open rollups
+    rollups = None
+    if rollup_writers is not None:
+        # Without an SLA threshold, rollups count no RTTs as exceeding it
+        sla_threshold = args.sla_threshold
+        if sla_threshold is None and args.threshold > 0:
+            sla_threshold = args.threshold
+        rollups = Rollups(rollup_writers, RTT_HISTOGRAM_BOUNDS, sla_threshold, 0 if switch is None else switch.index)
+    try:
+        poll_switch(args, sinks, switch, metrics, rollups)
+    except ReplayFinished as finished:
+        # Reads left over mean the replay asked for other reads than the recording made
+        if finished.num_unread > 0:
+            print("%sReplay ran out of %s reads with %d other reads left unserved" % ("" if switch is None
+                else "[%s] " % switch.name, finished.read, finished.num_unread), file=sys.stderr)
+    except ControllerError as error:
+        # Stop the other switches too, rather than carry on without this one
+        switch_errors.append(error)
+        stop_polling.set()
+    finally:
+        if rollups is not None:
+            with output_lock:
+                rollups.flush()
+
+def main(args):
+    if args.drain == 'digest' and (args.record is not None or args.replay is not None):
+        sys.exit("Digests can't be recorded or replayed; use another drain")
+    switches = None if args.topology is None else load_switches(args.topology)
+    sinks = []
+    if args.output is not None:
+        sinks.append(BinarySink(args.output, switches, args.raw_retention))
+    elif args.threshold <= 0:
+        sinks.append(CSVSink())
+    if args.export is not None:
+        sinks.append(UDPSink(args.export))
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = MetricsRegistry(RTT_HISTOGRAM_BOUNDS)
+        start_metrics_server(metrics, args.metrics_port)
+    rollup_writers = None
+    if args.rollups is not None:
+        rollup_writers = open_rollup_writers(args.rollups, RTT_HISTOGRAM_BOUNDS,
+            None if switches is None else [switch.name for switch in switches])
+    try:
+        if switches is None:
+            run_switch(args, sinks, metrics=metrics, rollup_writers=rollup_writers)
         else:
-            for new_rtt_etc in new_rtts_etc:
-                print("%d,%d,%s,%s,%d,%d,%d,%d" % new_rtt_etc)
-            if args.print_register_occupancy:
-                print(occupancies, "(Recorded", len(rtts), "RTTs, stale",
-                    current_latency_threshold, "µs)", file=sys.stderr)
+            # One thread per switch: polls are mostly waiting on the switches, so they overlap
+            threads = [threading.Thread(target=run_switch, args=(args, sinks, switch, metrics, rollup_writers),
+                name=switch.name)
+                for switch in switches]
+            for thread in threads:
+                thread.daemon = True # A second Ctrl-C stops them at once
+                thread.start()
+            try:
+                while any(thread.is_alive() for thread in threads):
+                    for thread in threads:
+                        thread.join(1)
+            except KeyboardInterrupt:
+                # Let every thread finish its poll and write its open rollups
+                print("Stopping after the current polls", file=sys.stderr)
+                stop_polling.set()
+                while any(thread.is_alive() for thread in threads):
+                    for thread in threads:
+                        thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for sink in sinks:
+            sink.close()
+        if rollup_writers is not None:
+            for writer in rollup_writers.values():
+                writer.close()
+    if switch_errors:
+        sys.exit("\n".join(str(error) for error in switch_errors))
 
 def premain():
     parser = argparse.ArgumentParser(description='Controller for RTT-P4')
     parser.add_argument('-t', '--threshold', dest='threshold', type=int,
         help='RTT SLA threshold in microseconds (default is 0, which means logging mode)',
         action="store", required=False, default=0)
+    parser.add_argument('-o', '--output', dest='output',
+        help='Write observed RTTs to this binary file (see observed_rtts.py) instead of CSV on stdout',
+        action="store", required=False, default=None)
+    parser.add_argument('-e', '--export', dest='export',
+        help='Also send observed RTTs to HOST:PORT over UDP (see rtt_export.py and rtt-collector.py)',
+        action="store", required=False, default=None)
+    parser.add_argument('--raw-retention', dest='raw_retention', type=float,
+        help='With -o, keep only about this many seconds of observed RTTs: the file is moved to FILE.1 '
+            '(replacing the one before) this often (default keep everything)',
+        action="store", required=False, default=None)
+    parser.add_argument('--rollups', dest='rollups',
+        help='Append per-second, per-10-seconds and per-minute RTT rollups (see rollups.py) '
+            'to PREFIX.1s, PREFIX.10s and PREFIX.60s',
+        action="store", required=False, default=None)
+    parser.add_argument('--sla-threshold', dest='sla_threshold', type=int,
+        help='RTT SLA threshold in microseconds counted by rollups (default is -t; none in logging mode)',
+        action="store", required=False, default=None)
     parser.add_argument('-r', '--reset', dest='reset',
         help='Reset timestamps and keys registers',
         action="store_true", required=False)
@@ -164,16 +1207,143 @@ def premain():
     parser.add_argument('-l', '--last', dest='auto_tune_num_recent_rtts', type=int,
         help='Number of most recent RTTs to consider when autotuning stale threshold (0 means last batch)',
         action="store", required=False, default=None)
+    parser.add_argument('-k', '--sketch-k', dest='sketch_k', type=int,
+        help='Size parameter of the autotuner quantile sketch; rank error is about 1.2/k (default 200)',
+        action="store", required=False, default=200)
     parser.add_argument('-m', '--max', dest='max_stale_rtt', type=int,
         help='Maximum stale RTT in microseconds',
         action="store", required=False, default=1000000)
+    parser.add_argument('--timestamp-bits', dest='timestamp_bits', type=int, choices=[32, 48],
+        help='Width of timestamps and latency_threshold in program.p4: 32 with WRAP_TIMESTAMPS_FLAG; '
+            'stale thresholds are kept below 2^32 microseconds (default 48)',
+        action="store", required=False, default=48)
+    parser.add_argument('--target-occupancy', dest='target_occupancy', type=float,
+        help='Instead of -a, tune the stale threshold with a PI controller holding the tables this full '
+            '(0 to 1), starting from -i and staying between --min-stale and -m',
+        action="store", required=False, default=None)
+    parser.add_argument('--kp', dest='kp', type=float,
+        help='Proportional gain of --target-occupancy, in microseconds per unit of fill error (default 500000)',
+        action="store", required=False, default=500000)
+    parser.add_argument('--ki', dest='ki', type=float,
+        help='Integral gain of --target-occupancy, in microseconds per unit of fill error per second '
+            '(default 50000)',
+        action="store", required=False, default=50000)
+    parser.add_argument('--min-stale', dest='min_stale_rtt', type=int,
+        help='Minimum stale threshold in microseconds for --target-occupancy (default 1000)',
+        action="store", required=False, default=1000)
+    parser.add_argument('--max-flows', dest='max_flows', type=int,
+        help='Number of flows with RTT aggregates kept in memory, least recently updated evicted first '
+            '(default 10000, 0 turns per-flow aggregation off)',
+        action="store", required=False, default=10000)
+    parser.add_argument('--top-flows', dest='num_slowest_flows', type=int,
+        help='Number of slowest flows (by smoothed RTT) to report (default 10)',
+        action="store", required=False, default=10)
+    parser.add_argument('--flow-sketch-k', dest='flow_sketch_k', type=int,
+        help='Size parameter of the per-flow quantile sketch; rank error is about 1.2/k (default 32)',
+        action="store", required=False, default=32)
+    parser.add_argument('--sample-budget', dest='sample_budget', type=float,
+        help='Adapt filter_percent (program.p4 with SUBSAMPLE_FLAG) to measure at most about this many RTTs '
+            'per second, within --table-fill-budget (default fixed at 0)',
+        action="store", required=False, default=None)
+    parser.add_argument('--table-fill-budget', dest='table_fill_budget', type=float,
+        help='Largest fraction of the tables --sample-budget lets fill (default 0.9)',
+        action="store", required=False, default=0.9)
+    parser.add_argument('--table-size', dest='table_size', type=int,
+        help='Slots per timestamp table, as compiled into program.p4 or, with --resizable, up to %d (default %d)'
+            % (MAX_TABLE_SIZE, TABLE_SIZE),
+        action="store", required=False, default=TABLE_SIZE)
+    parser.add_argument('--num-tables', dest='num_tables', type=int,
+        help='Number of timestamp tables in use: with --resizable, up to MULTI_TABLE of program.p4 '
+            '(default all the switch has)',
+        action="store", required=False, default=None)
+    parser.add_argument('--resizable', dest='resizable',
+        help='Set --table-size and --num-tables on the switch (program.p4 compiled with RESIZABLE_TABLES_FLAG); '
+            'changing them clears the tables',
+        action="store_true", required=False)
+    parser.add_argument('--read-timestamps', dest='read_timestamps',
+        help='Count occupancies from the whole timestamps register instead of table_occupancies (for debugging)',
+        action="store_true", required=False)
     parser.add_argument('-p', '--print', dest='print_register_occupancy',
         help='Always print occupancy of registers and other stats',
         action="store_true", required=False)
-    parser.add_argument('-s', '--sleep', dest='sleep', type=int,
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+        help='Serve live metrics in the Prometheus text format at http://localhost:PORT/metrics (default off)',
+        action="store", required=False, default=None)
+    parser.add_argument('--timing-interval', dest='timing_interval', type=float,
+        help='Every this many seconds, print percentiles of how long each phase of a poll took '
+            '(read, reset, parse, aggregate, occupancy, tune, emit) to stderr (default off)',
+        action="store", required=False, default=None)
+    parser.add_argument('--timing-trace', dest='timing_trace',
+        help='Write how long each phase of every poll took, in seconds, to this CSV file '
+            '(FILE.switch for each switch with --topology)',
+        action="store", required=False, default=None)
+    parser.add_argument('-s', '--sleep', dest='sleep', type=float,
         help='Sleep duration (refresh rate) in seconds (default is 5)',
         action="store", required=False, default=5)
+    parser.add_argument('-f', '--target-fill', dest='target_fill', type=float,
+        help='Adapt the sleep duration so each poll finds about this fraction of the RTT ring filled '
+            '(0 to 1, default is a fixed sleep duration)',
+        action="store", required=False, default=None)
+    parser.add_argument('--min-sleep', dest='min_sleep', type=float,
+        help='Shortest adaptive sleep duration in seconds (default 0.05)',
+        action="store", required=False, default=0.05)
+    parser.add_argument('--max-sleep', dest='max_sleep', type=float,
+        help='Longest adaptive sleep duration in seconds (default 30)',
+        action="store", required=False, default=30)
+    parser.add_argument('-d', '--drain', dest='drain', choices=sorted(DRAINS.keys()),
+        help='How to collect RTTs: read and reset the whole ring, read only slots written since the last poll, '
+            'flip bank_select and read the bank just written (program.p4 with DOUBLE_BANK_FLAG), '
+            'or receive P4Runtime digests as they are sent (program.p4 with DIGEST_FLAG) (default reset)',
+        action="store", required=False, default='reset')
+    parser.add_argument('--packed', dest='packed',
+        help='Read packed RTT records (program.p4 compiled with PACKED_RTTS_FLAG)',
+        action="store_true", required=False)
+    parser.add_argument('-b', '--backend', dest='backend', choices=sorted(BACKENDS.keys()),
+        help='How to reach the switch registers: in-process Thrift client or runtime_CLI.py child (default thrift)',
+        action="store", required=False, default='thrift')
+    parser.add_argument('--thrift-port', dest='thrift_port', type=int,
+        help='Thrift server port of the switch (default 9090)',
+        action="store", required=False, default=DEFAULT_THRIFT_PORT)
+    parser.add_argument('--record', dest='record',
+        help='Record every register read and write, with its time, to this file '
+            '(FILE.switch for each switch with --topology)',
+        action="store", required=False, default=None)
+    parser.add_argument('--replay', dest='replay',
+        help='Instead of polling a switch, replay a file from --record as fast as possible, '
+            'running the same processing and tuning on it (other options can differ from the recording)',
+        action="store", required=False, default=None)
+    parser.add_argument('--checkpoint', dest='checkpoint',
+        help='Save statistics, tuning state and the place in the RTT ring to this file (FILE.switch for each '
+            'switch with --topology); if it exists at startup, carry on from it without resetting or '
+            're-initializing the switch (RTTs read after the checkpoint may be output again)',
+        action="store", required=False, default=None)
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_interval', type=float,
+        help='Seconds between checkpoints (default 60)',
+        action="store", required=False, default=60)
+    parser.add_argument('--topology', dest='topology',
+        help='Poll every switch of this topology.json (as started by run_exercise.py) at once, '
+            'tagging output with the switch name; overrides --thrift-port and --grpc-port',
+        action="store", required=False, default=None)
+    parser.add_argument('--grpc-port', dest='grpc_port', type=int,
+        help='P4Runtime gRPC port of the switch, for -d digest (default 50051)',
+        action="store", required=False, default=DEFAULT_GRPC_PORT)
+    parser.add_argument('--p4info', dest='p4info',
+        help='P4Info file of the running program, for -d digest (default build/program.p4info)',
+        action="store", required=False, default='build/program.p4info')
     args = parser.parse_args()
+    if args.target_occupancy is not None and args.auto_tune_stale_threshold_percentile is not None:
+        parser.error('-a and --target-occupancy both tune the stale threshold; choose one')
+    if args.num_tables is not None and not 1 <= args.num_tables <= MAX_NUM_TABLES:
+        parser.error('--num-tables must be between 1 and %d' % MAX_NUM_TABLES)
+    if args.table_size < 1 or (args.resizable and args.table_size > MAX_TABLE_SIZE):
+        parser.error('--table-size must be between 1 and %d' % MAX_TABLE_SIZE)
+    # Stale thresholds must fit latency_threshold (the switch's RTTs always do)
+    max_threshold = 2 ** args.timestamp_bits - 1
+    args.initial_stale_threshold = min(args.initial_stale_threshold, max_threshold)
+    args.max_stale_rtt = min(args.max_stale_rtt, max_threshold)
+    args.min_stale_rtt = min(args.min_stale_rtt, max_threshold)
+    # Register index of the first slot of each table
+    args.table_stride = MAX_TABLE_SIZE if args.resizable else args.table_size
     main(args)
 
 if __name__ == '__main__':
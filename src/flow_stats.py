@@ -0,0 +1,81 @@
+# Encoding: utf-8
+
+# Per-flow RTT aggregates for controller.py, in bounded memory. Runs under Python 2 and 3.
+# Each flow keeps a count, min, max, smoothed RTT (EWMA, weighted as TCP's SRTT) and a small
+# KLL sketch for its 99th percentile. At most max_flows flows are kept: the flow updated
+# least recently is evicted first. The slowest flows (by smoothed RTT) are kept up to date
+# after every batch: while none of them gets faster or is evicted, only they and the flows
+# in the batch can be the slowest; otherwise every flow kept is considered (at most max_flows).
+
+import collections, heapq
+from quantile_sketch import KLLSketch
+
+# Weight of a new RTT in a flow's smoothed RTT (RFC 6298 uses 1/8)
+FLOW_RTT_EWMA_WEIGHT = 0.125
+
+class FlowStats(object):
+    """RTT aggregates of one flow"""
+
+    __slots__ = ['count', 'min_rtt', 'max_rtt', 'smoothed_rtt', 'sketch']
+
+    def __init__(self, sketch_k):
+        self.count = 0
+        self.min_rtt = None
+        self.max_rtt = None
+        self.smoothed_rtt = None
+        self.sketch = KLLSketch(sketch_k)
+
+    def add(self, rtt):
+        if self.count == 0:
+            self.min_rtt = self.max_rtt = self.smoothed_rtt = rtt
+        else:
+            self.min_rtt = min(self.min_rtt, rtt)
+            self.max_rtt = max(self.max_rtt, rtt)
+            self.smoothed_rtt += FLOW_RTT_EWMA_WEIGHT * (rtt - self.smoothed_rtt)
+        self.count += 1
+        self.sketch.add(rtt)
+
+    @property
+    def p99_rtt(self):
+        return self.sketch.quantile(0.99)
+
+class FlowTable(object):
+    """Aggregates of the max_flows most recently updated flows, and the num_slowest slowest of them"""
+
+    def __init__(self, max_flows, num_slowest, sketch_k):
+        self.max_flows = max_flows
+        self.num_slowest = num_slowest
+        self.sketch_k = sketch_k
+        self.flows = collections.OrderedDict() # Least recently updated first
+        self.num_evicted = 0
+        self.slowest_keys = []
+
+    def update(self, flow_keys, rtts):
+        slowest_rtts = dict((key, self.flows[key].smoothed_rtt) for key in self.slowest_keys)
+        touched = set()
+        for key, rtt in zip(flow_keys, rtts):
+            flow = self.flows.pop(key, None)
+            if flow is None:
+                flow = FlowStats(self.sketch_k)
+            self.flows[key] = flow # Now the most recently updated
+            flow.add(rtt)
+            touched.add(key)
+        while len(self.flows) > self.max_flows:
+            self.flows.popitem(last=False)
+            self.num_evicted += 1
+        if any(key not in self.flows or self.flows[key].smoothed_rtt < smoothed_rtt
+                for key, smoothed_rtt in slowest_rtts.items()):
+            # A flow idle since may now be among the slowest
+            candidates = self.flows.keys()
+        else:
+            candidates = set(self.slowest_keys)
+            candidates.update(key for key in touched if key in self.flows)
+        self.slowest_keys = heapq.nlargest(self.num_slowest, candidates,
+            key=lambda key: self.flows[key].smoothed_rtt)
+
+    def slowest(self):
+        # [(flow key, FlowStats)], slowest first
+        return [(key, self.flows[key]) for key in self.slowest_keys]
+
+    def __len__(self):
+        return len(self.flows)
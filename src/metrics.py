@@ -0,0 +1,123 @@
+# Encoding: utf-8
+
+# Live telemetry for controller.py --metrics-port, served over HTTP in the Prometheus text format
+# Runs under Python 2 and 3.
+# The poll loop only hands over its latest numbers (a few assignments under a lock);
+# formatting happens when the endpoint is scraped.
+
+import threading, collections
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+class MetricsRegistry(object):
+    """Latest metrics of every polled switch"""
+
+    def __init__(self, histogram_bounds):
+        # Upper bounds (microseconds) of the RTT histogram buckets, besides +Inf
+        self.histogram_bounds = histogram_bounds
+        self.lock = threading.Lock()
+        self.switches = collections.OrderedDict()
+
+    def update(self, switch_name, histogram, sum_of_rtts, num_rtts, occupancies, latency_threshold,
+            poll_duration, num_polls, sum_of_poll_durations, num_lost_rtts, slowest_flows=()):
+        # switch_name is None when the controller polls a single switch (no switch label);
+        # slowest_flows is [(flow name, smoothed RTT, p99 RTT, max RTT)]
+        values = {
+            'histogram': list(histogram),
+            'sum_of_rtts': sum_of_rtts,
+            'num_rtts': num_rtts,
+            'occupancies': list(occupancies),
+            'latency_threshold': latency_threshold,
+            'poll_duration': poll_duration,
+            'num_polls': num_polls,
+            'sum_of_poll_durations': sum_of_poll_durations,
+            'num_lost_rtts': num_lost_rtts,
+            'slowest_flows': list(slowest_flows)
+        }
+        with self.lock:
+            self.switches[switch_name] = values
+
+    def render(self):
+        with self.lock:
+            switches = list(self.switches.items())
+        lines = []
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, format_labels(labels), value))
+        def switch_labels(switch_name):
+            return [] if switch_name is None else [('switch', switch_name)]
+
+        samples = []
+        for switch_name, values in switches:
+            labels = switch_labels(switch_name)
+            cumulative = 0
+            for bound, count in zip(self.histogram_bounds + ['+Inf'], values['histogram']):
+                cumulative += count
+                samples.append(('rtt_p4_rtt_microseconds_bucket', labels + [('le', bound)], cumulative))
+            samples.append(('rtt_p4_rtt_microseconds_sum', labels, values['sum_of_rtts']))
+            samples.append(('rtt_p4_rtt_microseconds_count', labels, values['num_rtts']))
+        metric('rtt_p4_rtt_microseconds', 'histogram', 'RTTs observed by the switch', samples)
+
+        metric('rtt_p4_table_occupancy', 'gauge', 'Occupied slots of each timestamp table',
+            [('rtt_p4_table_occupancy', switch_labels(switch_name) + [('table', table)], occupancy)
+                for switch_name, values in switches for table, occupancy in enumerate(values['occupancies'])])
+        metric('rtt_p4_latency_threshold_microseconds', 'gauge', 'Current stale RTT threshold (latency_threshold)',
+            [('rtt_p4_latency_threshold_microseconds', switch_labels(switch_name), values['latency_threshold'])
+                for switch_name, values in switches])
+        metric('rtt_p4_last_poll_duration_seconds', 'gauge', 'Duration of the last poll, sleep excluded',
+            [('rtt_p4_last_poll_duration_seconds', switch_labels(switch_name), '%.6f' % values['poll_duration'])
+                for switch_name, values in switches])
+
+        samples = []
+        for switch_name, values in switches:
+            samples.append(('rtt_p4_poll_duration_seconds_sum', switch_labels(switch_name),
+                '%.6f' % values['sum_of_poll_durations']))
+            samples.append(('rtt_p4_poll_duration_seconds_count', switch_labels(switch_name), values['num_polls']))
+        metric('rtt_p4_poll_duration_seconds', 'summary', 'Durations of polls, sleep excluded', samples)
+
+        metric('rtt_p4_lost_rtts_total', 'counter', 'RTTs overwritten in the ring before they were read',
+            [('rtt_p4_lost_rtts_total', switch_labels(switch_name), values['num_lost_rtts'])
+                for switch_name, values in switches])
+
+        for statistic, position in [('smoothed', 1), ('p99', 2), ('max', 3)]:
+            name = 'rtt_p4_slowest_flow_%s_rtt_microseconds' % statistic
+            metric(name, 'gauge', 'RTT (%s) of the slowest flows' % statistic,
+                [(name, switch_labels(switch_name) + [('flow', flow[0])], int(flow[position]))
+                    for switch_name, values in switches for flow in values['slowest_flows']])
+        return '\n'.join(lines) + '\n'
+
+def start_metrics_server(registry, port, address='localhost'):
+    # Serves registry.render() at /metrics from a daemon thread
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass # Scrapes would otherwise clutter stderr
+
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
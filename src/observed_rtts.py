@@ -0,0 +1,78 @@
+# Encoding: utf-8
+
+# Binary file format for observed RTTs, written by controller.py -o and read by compare-rtts.py.
+# Runs under Python 2 and 3.
+# Layout: MAGIC, a 4-byte little-endian header length, a JSON header holding the NumPy
+# dtype of the records (padded with spaces to a multiple of 64 bytes), then the records
+# themselves, appended one batch per poll. IPs stay integers; nothing is formatted as text.
+
+import json, struct, os
+import numpy
+
+MAGIC = b'RTTP4OBS'
+
+# One observed RTT, with the same columns (in order) as the controller's CSV output
+OBSERVED_RTT_DTYPE = numpy.dtype([
+    ('rtt', '<u8'),
+    ('register_index', '<u4'),
+    ('src_ip', '<u4'),
+    ('dst_ip', '<u4'),
+    ('src_port', '<u2'),
+    ('dst_port', '<u2'),
+    ('seq', '<u4'),
+    ('ack', '<u4'),
+    ('sampling_percent', '<u1') # Percent of flows sampled (100 - filter_percent)
+])
+
+# The same, from controller.py --topology: switch indexes the switch names in the header
+SWITCH_OBSERVED_RTT_DTYPE = numpy.dtype(OBSERVED_RTT_DTYPE.descr + [('switch', '<u2')])
+
+def is_observed_rtts_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class ObservedRttWriter(object):
+    """Appends batches (NumPy arrays of dtype) of observed RTTs to a new file"""
+
+    def __init__(self, filename, dtype=OBSERVED_RTT_DTYPE, switch_names=None):
+        self.dtype = dtype
+        header = {'descr': dtype.descr}
+        if switch_names is not None:
+            header['switches'] = switch_names
+        header = json.dumps(header).encode('ascii')
+        header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 64)
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.file.flush()
+
+    def write(self, batch):
+        numpy.asarray(batch, dtype=self.dtype).tofile(self.file)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_header(filename):
+    # Returns the header and the offset of the first record
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not an observed RTTs file" % filename)
+        header_length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_length).decode('ascii'))
+    return header, len(MAGIC) + 4 + header_length
+
+def load_switch_names(filename):
+    # Names indexed by the switch field, or None for a single-switch file
+    switch_names = read_header(filename)[0].get('switches')
+    return None if switch_names is None else [str(name) for name in switch_names]
+
+def load_observed_rtts(filename):
+    # Memory-maps the records (no copy); a batch cut short by a killed controller is ignored
+    header, offset = read_header(filename)
+    # JSON turns the descr tuples into lists; a third item is the shape of an array field
+    dtype = numpy.dtype([(str(field[0]), str(field[1])) + tuple(tuple(shape) for shape in field[2:])
+        for field in header['descr']])
+    num_records = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if num_records == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(num_records,))
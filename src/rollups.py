@@ -0,0 +1,95 @@
+# Encoding: utf-8
+
+# Time-bucketed RTT rollups for controller.py --rollups. Runs under Python 2 and 3.
+# Every level (ROLLUP_SECONDS) has its own append-only file in the format of observed_rtts.py
+# (load it with load_observed_rtts), holding one record per switch and non-empty bucket.
+# Buckets are aligned to multiples of their length since the epoch, and a poll's RTTs all go in
+# the buckets of the poll's time, so buckets shorter than the poll interval are sparse.
+# A bucket is written once a poll falls past its end, or when the controller stops (flush).
+
+import numpy
+from observed_rtts import ObservedRttWriter
+
+# Lengths of the rollup levels in seconds
+ROLLUP_SECONDS = [1, 10, 60]
+
+def rollup_dtype(num_histogram_buckets):
+    return numpy.dtype([
+        ('start', '<i8'), # Seconds since the epoch
+        ('seconds', '<u4'),
+        ('switch', '<u2'), # Index into the header's switch names, 0 for a single switch
+        ('count', '<u8'),
+        ('sum', '<u8'),
+        ('min', '<u8'),
+        ('max', '<u8'),
+        ('exceeding', '<u8'), # RTTs over the SLA threshold (0 without one)
+        ('histogram', '<u8', (num_histogram_buckets,))
+    ])
+
+def rollup_filename(prefix, seconds):
+    return '%s.%ds' % (prefix, seconds)
+
+def open_rollup_writers(prefix, histogram_bounds, switch_names=None):
+    # {seconds: writer}, one file per level; histogram_bounds as in controller.py (+Inf is added)
+    dtype = rollup_dtype(len(histogram_bounds) + 1)
+    return dict((seconds, ObservedRttWriter(rollup_filename(prefix, seconds), dtype, switch_names))
+        for seconds in ROLLUP_SECONDS)
+
+class Rollup(object):
+    """The open bucket of one level for one switch"""
+
+    def __init__(self, seconds, writer, histogram_bounds, sla_threshold, switch_index):
+        self.seconds = seconds
+        self.writer = writer
+        self.histogram_bounds = numpy.array(histogram_bounds, dtype=numpy.uint64)
+        self.sla_threshold = sla_threshold
+        self.record = numpy.zeros(1, dtype=writer.dtype)
+        self.record['seconds'] = seconds
+        self.record['switch'] = switch_index
+        self.start = None
+
+    def add(self, now, rtts):
+        start = int(now // self.seconds) * self.seconds
+        if start != self.start:
+            self.flush()
+            self.start = start
+        if len(rtts) == 0:
+            return
+        record = self.record[0]
+        if record['count'] == 0:
+            record['min'] = rtts.min()
+            record['max'] = rtts.max()
+        else:
+            record['min'] = min(record['min'], rtts.min())
+            record['max'] = max(record['max'], rtts.max())
+        record['count'] += len(rtts)
+        record['sum'] += rtts.sum()
+        if self.sla_threshold is not None:
+            record['exceeding'] += numpy.count_nonzero(rtts > self.sla_threshold)
+        # Same buckets as bisect_left over the bounds
+        record['histogram'] += numpy.bincount(numpy.searchsorted(self.histogram_bounds, rtts, side='left'),
+            minlength=len(self.histogram_bounds) + 1).astype(numpy.uint64)
+
+    def flush(self):
+        if self.start is not None and self.record['count'][0] > 0:
+            self.record['start'] = self.start
+            self.writer.write(self.record)
+        for field in ['count', 'sum', 'min', 'max', 'exceeding', 'histogram']:
+            self.record[field] = 0
+
+class Rollups(object):
+    """Rolls one switch's RTTs up at every level"""
+
+    def __init__(self, writers, histogram_bounds, sla_threshold=None, switch_index=0):
+        self.levels = [Rollup(seconds, writers[seconds], histogram_bounds, sla_threshold, switch_index)
+            for seconds in sorted(writers)]
+
+    def add(self, now, rtts):
+        # rtts is a NumPy array of the RTTs (microseconds) of one poll
+        for level in self.levels:
+            level.add(now, rtts)
+
+    def flush(self):
+        # Writes the open buckets, as when the controller stops
+        for level in self.levels:
+            level.flush()
@@ -0,0 +1,42 @@
+# Receive observed RTTs exported by controller.py --export and append them to a file
+# Usage: python3 rtt-collector.py path/to/collected_rtts.bin 9999
+# Note: Replace 9999 with the UDP port given to --export. Listens on all addresses.
+# The file is in the binary format of observed_rtts.py (records of SWITCH_OBSERVED_RTT_DTYPE, with the
+# switch index from the controller), so compare-rtts.py reads it as observed RTTs.
+# Datagrams missing from an exporter's sequence are reported on stderr.
+
+from __future__ import print_function
+import sys, socket
+from observed_rtts import SWITCH_OBSERVED_RTT_DTYPE, ObservedRttWriter
+from rtt_export import unpack_datagram
+
+output_filename = sys.argv[1]
+port = 9999
+if len(sys.argv) > 2:
+    port = int(sys.argv[2])
+
+writer = ObservedRttWriter(output_filename, SWITCH_OBSERVED_RTT_DTYPE)
+collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+collector.bind(('', port))
+
+# Next sequence number expected from each exporter (address)
+next_sequences = dict()
+num_records = 0
+try:
+    while True:
+        datagram, exporter = collector.recvfrom(65535)
+        try:
+            sequence, records = unpack_datagram(datagram)
+        except ValueError as error:
+            print("Ignored datagram from %s:%d: %s" % (exporter[0], exporter[1], error), file=sys.stderr)
+            continue
+        if exporter in next_sequences and sequence != next_sequences[exporter]:
+            print("Missed %d datagrams from %s:%d" % ((sequence - next_sequences[exporter]) % 2 ** 32,
+                exporter[0], exporter[1]), file=sys.stderr)
+        next_sequences[exporter] = (sequence + 1) % 2 ** 32
+        writer.write(records)
+        num_records += len(records)
+except KeyboardInterrupt:
+    print("Collected %d RTTs" % num_records, file=sys.stderr)
+finally:
+    writer.close()
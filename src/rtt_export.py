@@ -0,0 +1,47 @@
+# Encoding: utf-8
+
+# Compact UDP datagram format for exporting observed RTTs (controller.py --export, rtt-collector.py)
+# Runs under Python 2 and 3.
+# A datagram is a header (EXPORT_HEADER: magic, version, number of records, sequence number of the
+# datagram from its exporter) followed by that many EXPORT_DTYPE records. Everything is big-endian.
+# Datagrams hold at most MAX_RECORDS_PER_DATAGRAM records, so they fit an Ethernet MTU unfragmented.
+
+import struct
+import numpy
+from observed_rtts import SWITCH_OBSERVED_RTT_DTYPE
+
+EXPORT_MAGIC = b'RTTX'
+EXPORT_VERSION = 1
+EXPORT_HEADER = struct.Struct('!4sBxHI')
+
+# The fields of SWITCH_OBSERVED_RTT_DTYPE, in network byte order
+EXPORT_DTYPE = numpy.dtype([(name, SWITCH_OBSERVED_RTT_DTYPE[name].newbyteorder('>'))
+    for name in SWITCH_OBSERVED_RTT_DTYPE.names])
+
+# 1500 bytes of Ethernet payload, less IPv4 and UDP headers
+MAX_DATAGRAM_SIZE = 1472
+MAX_RECORDS_PER_DATAGRAM = (MAX_DATAGRAM_SIZE - EXPORT_HEADER.size) // EXPORT_DTYPE.itemsize
+
+def pack_datagrams(records, sequence):
+    # records is an array with (at least) the fields of EXPORT_DTYPE; sequence numbers the first datagram
+    export_records = numpy.zeros(len(records), dtype=EXPORT_DTYPE)
+    for name in EXPORT_DTYPE.names:
+        export_records[name] = records[name]
+    datagrams = []
+    for start in range(0, len(export_records), MAX_RECORDS_PER_DATAGRAM):
+        chunk = export_records[start:start + MAX_RECORDS_PER_DATAGRAM]
+        header = EXPORT_HEADER.pack(EXPORT_MAGIC, EXPORT_VERSION, len(chunk), (sequence + len(datagrams)) % 2 ** 32)
+        datagrams.append(header + chunk.tobytes())
+    return datagrams
+
+def unpack_datagram(datagram):
+    # Returns the sequence number and records (as SWITCH_OBSERVED_RTT_DTYPE) of a datagram
+    if len(datagram) < EXPORT_HEADER.size:
+        raise ValueError("datagram too short")
+    magic, version, num_records, sequence = EXPORT_HEADER.unpack_from(datagram)
+    if magic != EXPORT_MAGIC or version != EXPORT_VERSION:
+        raise ValueError("not an RTT export datagram (version %d)" % EXPORT_VERSION)
+    if len(datagram) != EXPORT_HEADER.size + num_records * EXPORT_DTYPE.itemsize:
+        raise ValueError("datagram length doesn't match its %d records" % num_records)
+    records = numpy.frombuffer(datagram, dtype=EXPORT_DTYPE, count=num_records, offset=EXPORT_HEADER.size)
+    return sequence, records.astype(SWITCH_OBSERVED_RTT_DTYPE)
@@ -15,6 +15,7 @@
 from Queue import Queue
 from abc import abstractmethod
 from datetime import datetime
+import threading
 
 import grpc
 from p4 import p4runtime_pb2
@@ -96,6 +97,45 @@ class SwitchConnection(object):
         else:
             self.client_stub.Write(request)
 
+    def WriteDigestEntry(self, digest_id, max_timeout_ns=0, max_list_size=1, ack_timeout_ns=0, dry_run=False):
+        request = p4runtime_pb2.WriteRequest()
+        request.device_id = self.device_id
+        request.election_id.low = 1
+        update = request.updates.add()
+        update.type = p4runtime_pb2.Update.INSERT
+        digest_entry = update.entity.digest_entry
+        digest_entry.digest_id = digest_id
+        digest_entry.config.max_timeout_ns = max_timeout_ns
+        digest_entry.config.max_list_size = max_list_size
+        digest_entry.config.ack_timeout_ns = ack_timeout_ns
+        if dry_run:
+            print "P4Runtime Write:", request
+        else:
+            self.client_stub.Write(request)
+
+    def AckDigestList(self, digest_list):
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.digest_ack.digest_id = digest_list.digest_id
+        request.digest_ack.list_id = digest_list.list_id
+        self.requests_stream.put(request)
+
+    def StartStreamListener(self, digest_callback):
+        """Starts a background thread that reads the StreamChannel and calls
+        digest_callback with every DigestList the switch sends (acking each one).
+        Call after MasterArbitrationUpdate, which reads the stream itself."""
+        def listen():
+            try:
+                for item in self.stream_msg_resp:
+                    if item.WhichOneof('update') == 'digest':
+                        self.AckDigestList(item.digest)
+                        digest_callback(item.digest)
+            except grpc.RpcError:
+                pass # The stream was cancelled by shutdown()
+        listener = threading.Thread(target=listen, name='%s-stream' % self.name)
+        listener.daemon = True
+        listener.start()
+        return listener
+
     def ReadTableEntries(self, table_id=None, dry_run=False):
         request = p4runtime_pb2.ReadRequest()
         request.device_id = self.device_id